@@ -1,16 +1,20 @@
+import html
+import asyncio
 import logging
 
 from aiogram import Router, F
 from aiogram.types import Message, CallbackQuery
-from aiogram.filters import Command, CommandStart
+from aiogram.filters import Command, CommandObject, CommandStart
 from aiogram.fsm.context import FSMContext
 
 from bot.states import UserStates
 from bot.keyboards import get_main_keyboard, get_cancel_keyboard, get_confirm_clear_keyboard
-from rag.document_processor import load_document, split_documents
-from rag.retriever import  generate_response, extract_sources
-from rag.utils import save_telegram_file, is_supported_file_type
+from rag.document_processor import iter_document, split_documents
+from rag.retriever import  agenerate_response, extract_sources
+from rag.query import analyze_query
+from rag.utils import is_supported_file_type, get_supported_formats
 from database.storage import VectorStorage
+from database.metadata_index import MetadataFilter
 
 # Инициализация роутера
 router = Router()
@@ -26,7 +30,7 @@ async def cmd_start(message: Message, state: FSMContext):
     await message.answer(
         "Привет! Я бот для работы с документами и ответов на вопросы.\n\n"
         "Я могу:\n"
-        "📁 Загружать документы (PDF, FB2, TXT)\n"
+        f"📁 Загружать документы ({get_supported_formats()})\n"
         "❓ Отвечать на вопросы по загруженным документам\n"
         "🔄 Очищать базу данных\n\n"
         "Выберите действие:",
@@ -40,22 +44,81 @@ async def cmd_help(message: Message):
     await message.answer(
         "📚 <b>Справка по использованию бота:</b>\n\n"
         "1️⃣ <b>Загрузка документов</b>\n"
-        "Нажмите '📁 Загрузить документ' и отправьте файл в формате PDF, FB2 или TXT.\n\n"
+        f"Нажмите '📁 Загрузить документ' и отправьте файл в одном из форматов: {get_supported_formats()}.\n\n"
         "2️⃣ <b>Задать вопрос</b>\n"
         "Нажмите '❓ Задать вопрос' и введите ваш запрос по содержимому документов.\n\n"
         "3️⃣ <b>Очистка базы</b>\n"
         "Нажмите '🔄 Очистить базу' для удаления всех загруженных документов.\n\n"
+        "4️⃣ <b>Поиск по одному документу</b>\n"
+        "/docs - список загруженных документов\n"
+        "/scope &lt;имя файла&gt; - задавать вопросы только по этому документу\n"
+        "/scope - снова искать по всем документам\n\n"
         "ℹ️ Для возврата в главное меню используйте команду /start",
         parse_mode="HTML"
     )
 
 
+# Обработчик команды /docs
+@router.message(Command("docs"))
+async def cmd_docs(message: Message, state: FSMContext):
+    sources = storage.list_sources()
+
+    if not sources:
+        await message.answer(
+            "В базе нет загруженных документов.",
+            reply_markup=get_main_keyboard()
+        )
+        return
+
+    data = await state.get_data()
+    scope = data.get("scope")
+    documents_text = "\n".join(
+        f"{'👉 ' if source == scope else '- '}{html.escape(source)} ({count} фрагм.)"
+        for source, count in sorted(sources.items())
+    )
+
+    await message.answer(
+        f"<b>Загруженные документы:</b>\n{documents_text}\n\n"
+        "Чтобы задавать вопросы только по одному документу, используйте /scope &lt;имя файла&gt;",
+        parse_mode="HTML"
+    )
+
+
+# Обработчик команды /scope
+@router.message(Command("scope"))
+async def cmd_scope(message: Message, state: FSMContext, command: CommandObject):
+    source = (command.args or "").strip()
+
+    if not source:
+        await state.update_data(scope=None)
+        await message.answer(
+            "🔎 Поиск снова выполняется по всем документам.",
+            reply_markup=get_main_keyboard()
+        )
+        return
+
+    if source not in storage.list_sources():
+        await message.answer(
+            "❌ Документ не найден. Список загруженных документов: /docs",
+            reply_markup=get_main_keyboard()
+        )
+        return
+
+    await state.update_data(scope=source)
+    await message.answer(
+        f"🔎 Вопросы будут искаться только в документе <b>{html.escape(source)}</b>.\n"
+        "Чтобы снять ограничение, отправьте /scope без аргументов.",
+        parse_mode="HTML",
+        reply_markup=get_main_keyboard()
+    )
+
+
 # Обработчик кнопки "Загрузить документ"
 @router.message(F.text == "📁 Загрузить документ")
 async def upload_document_button(message: Message, state: FSMContext):
     await state.set_state(UserStates.WAITING_FOR_FILE)
     await message.answer(
-        "Пожалуйста, отправьте документ в формате PDF, FB2 или TXT.",
+        f"Пожалуйста, отправьте документ в одном из форматов: {get_supported_formats()}.",
         reply_markup=get_cancel_keyboard()
     )
 
@@ -93,7 +156,8 @@ async def cancel_operation(message: Message, state: FSMContext):
 @router.callback_query(F.data == "confirm_clear")
 async def confirm_clear_database(callback: CallbackQuery):
     try:
-        storage.clear()
+        # Очистка ждет завершения текущих поисков, поэтому не блокирует цикл событий
+        await asyncio.to_thread(storage.clear)
         await callback.message.answer(
             "✅ База данных успешно очищена. Все документы удалены.",
             reply_markup=get_main_keyboard()
@@ -127,7 +191,7 @@ async def process_document(message: Message, state: FSMContext):
     # Проверяем поддерживаемый формат
     if not is_supported_file_type(file_name):
         await message.answer(
-            "❌ Неподдерживаемый формат файла. Пожалуйста, загрузите документ в формате PDF, FB2 или TXT.",
+            f"❌ Неподдерживаемый формат файла. Пожалуйста, загрузите документ в одном из форматов: {get_supported_formats()}.",
             reply_markup=get_cancel_keyboard()
         )
         return
@@ -135,16 +199,13 @@ async def process_document(message: Message, state: FSMContext):
     await message.answer("⏳ Загрузка и обработка документа...")
 
     try:
-        # Загружаем файл
+        # Загружаем файл в память и разбираем его без записи на диск
         file_content = await message.bot.download(document)
 
-        # Сохраняем файл во временную директорию
-        file_path = save_telegram_file(file_content, file_name)
-
-        # Загружаем документ
-        documents = load_document(file_path)
+        # Разбиваем на чанки по мере чтения страниц/разделов/глав (в отдельном потоке)
+        chunks = await asyncio.to_thread(split_documents, iter_document(file_content, file_name))
 
-        if not documents:
+        if not chunks:
             await message.answer(
                 "❌ Не удалось извлечь текст из документа. Возможно, файл поврежден или защищен.",
                 reply_markup=get_main_keyboard()
@@ -152,11 +213,8 @@ async def process_document(message: Message, state: FSMContext):
             await state.set_state(UserStates.IDLE)
             return
 
-        # Разбиваем на чанки
-        chunks = split_documents(documents)
-
-        # Добавляем в базу
-        storage.add_documents(chunks)
+        # Добавляем в базу: эмбеддинги считаются через API, цикл событий не ждет
+        await asyncio.to_thread(storage.add_documents, chunks)
 
         await message.answer(
             f"✅ Документ успешно загружен и обработан!\n\n"
@@ -193,8 +251,15 @@ async def process_query(message: Message, state: FSMContext):
     await message.answer("🔍 Ищу ответ на ваш вопрос...")
 
     try:
-        # Получаем ретривер и выполняем поиск
-        found_documents = storage.search(query)
+        # Ограничиваем поиск выбранным документом, если он задан через /scope
+        data = await state.get_data()
+        scope = data.get("scope")
+        metadata_filter = MetadataFilter(source=scope) if scope else None
+
+        # Анализируем вопрос один раз: токены для BM25 и эмбеддинг для векторного поиска.
+        # Поиск ждет удаленный эмбеддинг, поэтому выполняется вне цикла событий
+        analysis = analyze_query(query, storage.embeddings)
+        found_documents = await asyncio.to_thread(storage.search, analysis, metadata_filter=metadata_filter)
 
         if not found_documents:
             await message.answer(
@@ -204,8 +269,8 @@ async def process_query(message: Message, state: FSMContext):
             await state.set_state(UserStates.IDLE)
             return
 
-        # Генерируем ответ
-        response = generate_response(query, found_documents)
+        # Генерируем ответ (запрос проходит через общую очередь к OpenRouter)
+        response = await agenerate_response(query, found_documents, user_id=message.from_user.id)
 
         # Извлекаем источники
         sources = extract_sources(found_documents)
@@ -226,6 +291,13 @@ async def process_query(message: Message, state: FSMContext):
             reply_markup=get_main_keyboard()
         )
         await state.set_state(UserStates.IDLE)
+    except asyncio.TimeoutError:
+        logging.warning("Истекло время ожидания в очереди к OpenRouter")
+        await message.answer(
+            "⏳ Сейчас слишком много запросов. Пожалуйста, повторите вопрос чуть позже.",
+            reply_markup=get_main_keyboard()
+        )
+        await state.set_state(UserStates.IDLE)
     except Exception as e:
         logging.error(f"Ошибка при обработке запроса: {e}")
         await message.answer(
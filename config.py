@@ -10,12 +10,28 @@ TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "")
 
 # Настройки базы данных
 CHROMA_DB_DIR = os.getenv("CHROMA_DB_DIR", "")
+CHROMA_COLLECTION = "langchain"
+SNAPSHOT_BATCH_SIZE = 1000
 
 # Настройки для обработки документов
 CHUNK_SIZE = 1000
 CHUNK_OVERLAP = 200
 RETRIEVER_TOP_K = 3
 
+# Настройки для пакетной загрузки документов
+INGEST_WORKERS = os.cpu_count() or 1
+INGEST_BATCH_SIZE = 512
+INGEST_CHECKPOINT = os.path.join(CHROMA_DB_DIR, "ingest_checkpoint.json")
+EMBEDDING_BATCH_SIZE = 64
+
 # Настройки для модели
 MODEL_NAME = "qwen/qwen3-235b-a22b:free"
-EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
\ No newline at end of file
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+FALLBACK_MODEL_NAME = os.getenv("FALLBACK_MODEL_NAME", "")
+
+# Ограничения запросов к OpenRouter
+LLM_RATE_LIMIT = 1.0  # запросов в секунду
+LLM_RATE_BURST = 5
+LLM_MAX_IN_FLIGHT = 4
+LLM_QUEUE_DEADLINE = 120.0  # секунд ожидания в очереди
+LLM_FALLBACK_LATENCY = 20.0  # секунд ожидания, после которых используется резервная модель
\ No newline at end of file
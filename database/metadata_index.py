@@ -0,0 +1,125 @@
+import bisect
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Set, Tuple
+from langchain_core.documents import Document
+
+
+class MetadataFilter:
+    """Условия отбора фрагментов по метаданным (все условия объединяются через И)"""
+
+    def __init__(self,
+                 source: Optional[str] = None,
+                 file_type: Optional[str] = None,
+                 page_from: Optional[int] = None,
+                 page_to: Optional[int] = None,
+                 uploaded_after: Optional[float] = None,
+                 uploaded_before: Optional[float] = None):
+        self.source = source
+        self.file_type = file_type
+        self.page_from = page_from
+        self.page_to = page_to
+        self.uploaded_after = uploaded_after
+        self.uploaded_before = uploaded_before
+
+    def exact_conditions(self) -> Dict[str, Any]:
+        """Условия на точное совпадение значения поля"""
+        conditions = {"source": self.source, "file_type": self.file_type}
+        return {field: value for field, value in conditions.items() if value is not None}
+
+    def range_conditions(self) -> Dict[str, Tuple[Optional[float], Optional[float]]]:
+        """Условия на диапазон значений поля (границы включаются)"""
+        conditions = {
+            "page": (self.page_from, self.page_to),
+            "uploaded_at": (self.uploaded_after, self.uploaded_before),
+        }
+        return {field: bounds for field, bounds in conditions.items() if bounds != (None, None)}
+
+    def is_empty(self) -> bool:
+        return not self.exact_conditions() and not self.range_conditions()
+
+    def to_chroma_where(self) -> Optional[Dict[str, Any]]:
+        """Преобразует фильтр в условие where для Chroma"""
+        clauses = [{field: {"$eq": value}} for field, value in self.exact_conditions().items()]
+        for field, (low, high) in self.range_conditions().items():
+            if low is not None:
+                clauses.append({field: {"$gte": low}})
+            if high is not None:
+                clauses.append({field: {"$lte": high}})
+
+        if not clauses:
+            return None
+        if len(clauses) == 1:
+            return clauses[0]
+        return {"$and": clauses}
+
+
+class MetadataIndex:
+    """Индекс метаданных фрагментов для отбора кандидатов до ранжирования.
+
+    Для полей с точным совпадением хранятся списки позиций (posting lists),
+    для числовых полей - отсортированные пары (значение, позиция).
+    """
+
+    EXACT_FIELDS = ("source", "file_type")
+    RANGE_FIELDS = ("page", "uploaded_at")
+
+    def __init__(self, documents: Optional[List[Document]] = None):
+        self.size = 0
+        self._postings: Dict[str, Dict[Any, List[int]]] = {field: defaultdict(list) for field in self.EXACT_FIELDS}
+        self._ranges: Dict[str, List[Tuple[float, int]]] = {field: [] for field in self.RANGE_FIELDS}
+
+        if documents:
+            self.add(documents)
+
+    def add(self, documents: List[Document]) -> None:
+        """Добавляет фрагменты, позиции продолжают нумерацию списка документов"""
+        new_entries: Dict[str, List[Tuple[float, int]]] = {field: [] for field in self.RANGE_FIELDS}
+
+        for position, doc in enumerate(documents, start=self.size):
+            for field in self.EXACT_FIELDS:
+                value = doc.metadata.get(field)
+                if value is not None:
+                    self._postings[field][value].append(position)
+            for field in self.RANGE_FIELDS:
+                value = doc.metadata.get(field)
+                if value is not None:
+                    new_entries[field].append((value, position))
+        self.size += len(documents)
+
+        # Одна сортировка на пакет вместо вставки каждого значения по отдельности
+        for field, entries in new_entries.items():
+            if not entries:
+                continue
+            entries.sort()
+            existing = self._ranges[field]
+            needs_sort = bool(existing) and entries[0] < existing[-1]
+            existing.extend(entries)
+            if needs_sort:
+                existing.sort()
+
+    def select(self, metadata_filter: MetadataFilter) -> Set[int]:
+        """Возвращает позиции фрагментов, удовлетворяющих фильтру"""
+        candidates: List[Set[int]] = []
+
+        for field, value in metadata_filter.exact_conditions().items():
+            candidates.append(set(self._postings[field].get(value, ())))
+
+        for field, (low, high) in metadata_filter.range_conditions().items():
+            entries = self._ranges[field]
+            start = 0 if low is None else bisect.bisect_left(entries, (low, -1))
+            end = len(entries) if high is None else bisect.bisect_right(entries, (high, self.size))
+            candidates.append({position for _, position in entries[start:end]})
+
+        if not candidates:
+            return set(range(self.size))
+
+        # Пересекаем начиная с самого короткого списка
+        candidates.sort(key=len)
+        selected = candidates[0]
+        for positions in candidates[1:]:
+            selected = selected & positions
+        return selected
+
+    def count_by(self, field: str) -> Dict[Any, int]:
+        """Количество фрагментов для каждого значения поля"""
+        return {value: len(positions) for value, positions in self._postings[field].items()}
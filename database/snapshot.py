@@ -0,0 +1,144 @@
+import os
+import json
+import time
+import struct
+import zipfile
+from typing import Any, Dict, Iterator, List, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+
+# Формат и версия архива снимка
+SNAPSHOT_FORMAT = "geo-rag-snapshot"
+SNAPSHOT_VERSION = 2
+
+MANIFEST_NAME = "manifest.json"
+# Все метаданные хранятся в JSON: снимки передаются между узлами,
+# а разбор pickle из чужого архива позволяет выполнить произвольный код
+DOCUMENTS_NAME = "documents.json"
+RECORDS_NAME = "records.json"
+VECTORS_NAME = "vectors.bin"
+SCALES_NAME = "scales.bin"
+
+# Сигнатура и размер локального заголовка файла в zip-архиве
+LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+LOCAL_HEADER_SIZE = 30
+
+
+def quantize_vectors(vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Квантование векторов в int8 с отдельным масштабом для каждой строки"""
+    scales = np.abs(vectors).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    quantized = np.round(vectors / scales[:, None]).astype(np.int8)
+    return quantized, scales.astype(np.float32)
+
+
+def _member_offset(archive_path: str, info: zipfile.ZipInfo) -> int:
+    """Смещение данных файла внутри zip-архива (для несжатых файлов)"""
+    with open(archive_path, 'rb') as f:
+        f.seek(info.header_offset)
+        header = f.read(LOCAL_HEADER_SIZE)
+
+    if header[:4] != LOCAL_HEADER_SIGNATURE:
+        raise ValueError(f"Поврежден заголовок {info.filename} в снимке")
+
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    return info.header_offset + LOCAL_HEADER_SIZE + name_length + extra_length
+
+
+def _map_member(archive_path: str, archive: zipfile.ZipFile, name: str,
+                dtype: Any, shape: Tuple[int, ...]) -> np.ndarray:
+    """Отображает несжатый файл из архива в память без чтения целиком"""
+    info = archive.getinfo(name)
+    if info.compress_type != zipfile.ZIP_STORED:
+        return np.frombuffer(archive.read(name), dtype=dtype).reshape(shape)
+
+    return np.memmap(archive_path, dtype=dtype, mode='r',
+                     offset=_member_offset(archive_path, info), shape=shape)
+
+
+def write_snapshot(snapshot_path: str,
+                   documents: List[Document],
+                   records: Dict[str, list],
+                   vectors: np.ndarray,
+                   manifest: Dict[str, Any],
+                   quantize: bool = False) -> Dict[str, Any]:
+    """Записывает снимок в один zip-архив (без сжатия, чтобы векторы можно было отобразить в память).
+
+    Статистика BM25 не сохраняется: она пересчитывается из документов
+    при восстановлении без обращения к API эмбеддингов.
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    scales = None
+    if quantize and len(vectors):
+        vectors, scales = quantize_vectors(vectors)
+
+    manifest = dict(manifest)
+    manifest.update({
+        "format": SNAPSHOT_FORMAT,
+        "version": SNAPSHOT_VERSION,
+        "created_at": time.time(),
+        "count": int(vectors.shape[0]),
+        "dimension": int(vectors.shape[1]) if vectors.ndim == 2 else 0,
+        "dtype": "int8" if scales is not None else "float32",
+        "documents": len(documents),
+    })
+    documents_data = [{"page_content": doc.page_content, "metadata": doc.metadata} for doc in documents]
+
+    # Пишем во временный файл, чтобы не оставить наполовину записанный снимок
+    tmp_path = f"{snapshot_path}.tmp"
+    with zipfile.ZipFile(tmp_path, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+        archive.writestr(MANIFEST_NAME, json.dumps(manifest, ensure_ascii=False, indent=2))
+        archive.writestr(DOCUMENTS_NAME, json.dumps(documents_data, ensure_ascii=False))
+        archive.writestr(RECORDS_NAME, json.dumps(records, ensure_ascii=False))
+        # В пустом хранилище векторов нет, читатель это учитывает по count
+        if manifest["count"]:
+            with archive.open(VECTORS_NAME, 'w', force_zip64=True) as f:
+                f.write(memoryview(vectors).cast('B'))
+        if scales is not None:
+            archive.writestr(SCALES_NAME, scales.tobytes())
+    os.replace(tmp_path, snapshot_path)
+
+    return manifest
+
+
+class Snapshot:
+    """Открытый снимок хранилища; векторы читаются через отображение файла в память"""
+
+    def __init__(self, snapshot_path: str):
+        self.path = snapshot_path
+
+        with zipfile.ZipFile(snapshot_path) as archive:
+            self.manifest = json.loads(archive.read(MANIFEST_NAME))
+            if self.manifest.get("format") != SNAPSHOT_FORMAT:
+                raise ValueError("Файл не является снимком хранилища")
+            if self.manifest.get("version") != SNAPSHOT_VERSION:
+                raise ValueError(f"Неподдерживаемая версия снимка: {self.manifest.get('version')}")
+
+            self.documents: List[Document] = [
+                Document(page_content=item["page_content"], metadata=item["metadata"])
+                for item in json.loads(archive.read(DOCUMENTS_NAME))
+            ]
+            self.records: Dict[str, list] = json.loads(archive.read(RECORDS_NAME))
+
+            count = self.manifest["count"]
+            dimension = self.manifest["dimension"]
+            quantized = self.manifest["dtype"] == "int8"
+
+            self.vectors = None
+            self.scales = None
+            if count:
+                self.vectors = _map_member(snapshot_path, archive, VECTORS_NAME,
+                                           np.int8 if quantized else np.float32, (count, dimension))
+                if quantized:
+                    self.scales = _map_member(snapshot_path, archive, SCALES_NAME, np.float32, (count,))
+
+    def iter_batches(self, batch_size: int) -> Iterator[Tuple[slice, np.ndarray]]:
+        """Перебирает векторы пакетами в float32; с диска читаются только нужные страницы"""
+        count = self.manifest["count"]
+        for start in range(0, count, batch_size):
+            batch = slice(start, min(start + batch_size, count))
+            vectors = np.asarray(self.vectors[batch], dtype=np.float32)
+            if self.scales is not None:
+                vectors = vectors * self.scales[batch][:, None]
+            yield batch, vectors
@@ -1,13 +1,81 @@
 import os
 import json
+import time
+import fcntl
+import heapq
 import pickle
-from typing import List, Optional, Dict, Any
+import uuid
+import threading
+from contextlib import contextmanager
+from typing import List, Optional, Dict, Any, Iterator, Union
+import chromadb
+import numpy as np
 from langchain_community.vectorstores import Chroma
 from langchain_core.documents import Document
 from langchain_community.retrievers import BM25Retriever
 from langchain.retrievers import EnsembleRetriever
+from rank_bm25 import BM25Okapi
 from rag.embeddings import HuggingFaceEmbeddings
-from config import CHROMA_DB_DIR, RETRIEVER_TOP_K
+from database.metadata_index import MetadataFilter, MetadataIndex
+from database.snapshot import Snapshot, write_snapshot
+from rag.query import QueryAnalysis, analyze_query, tokenize
+from config import (
+    CHROMA_DB_DIR, CHROMA_COLLECTION, RETRIEVER_TOP_K, SNAPSHOT_BATCH_SIZE, EMBEDDING_MODEL,
+    INGEST_CHECKPOINT
+)
+
+# Константа сглаживания для Reciprocal Rank Fusion (как в EnsembleRetriever)
+RRF_C = 60
+
+
+def reciprocal_rank_fusion(results: List[List[Document]], weights: List[float]) -> List[Document]:
+    """Объединяет ранжированные списки документов взвешенным Reciprocal Rank Fusion"""
+    scores: Dict[str, float] = {}
+    documents: Dict[str, Document] = {}
+
+    for docs, weight in zip(results, weights):
+        for rank, doc in enumerate(docs, start=1):
+            key = doc.page_content
+            scores[key] = scores.get(key, 0.0) + weight / (rank + RRF_C)
+            documents.setdefault(key, doc)
+
+    return [documents[key] for key in sorted(scores, key=scores.get, reverse=True)]
+
+
+class ReadWriteLock:
+    """Блокировка, допускающая много читателей или одного писателя"""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._readers = 0
+        self._writer = False
+
+    @contextmanager
+    def read(self) -> Iterator[None]:
+        with self._condition:
+            while self._writer:
+                self._condition.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._readers -= 1
+                if not self._readers:
+                    self._condition.notify_all()
+
+    @contextmanager
+    def write(self) -> Iterator[None]:
+        with self._condition:
+            while self._writer or self._readers:
+                self._condition.wait()
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writer = False
+                self._condition.notify_all()
 
 
 class VectorStorage:
@@ -15,57 +83,127 @@ class VectorStorage:
         self.persist_directory = persist_directory
         self.embeddings = HuggingFaceEmbeddings()
         self.documents_path = os.path.join(persist_directory, "documents.pkl")
+        self.store_lock_path = os.path.join(persist_directory, "store.lock")
+        # Поиск идет под блокировкой на чтение, изменения хранилища - на запись
+        self._lock = ReadWriteLock()
 
         # Создаем директорию, если она не существует
         os.makedirs(persist_directory, exist_ok=True)
 
+        # Хранилище принадлежит одному процессу, пока открыт этот объект
+        self._store_lock_file = self._acquire_store_lock()
+
         # Загружаем документы для BM25, если они существуют
+        self._set_documents(self._load_documents())
+
+        # Инициализируем хранилище через собственный клиент Chroma
+        self.client = chromadb.PersistentClient(path=persist_directory)
+        self.collection_name = CHROMA_COLLECTION
+        self.db = self._open_collection()
+
+    def _open_collection(self) -> Chroma:
+        return Chroma(
+            client=self.client,
+            collection_name=self.collection_name,
+            embedding_function=self.embeddings
+        )
+
+    def _set_documents(self, documents: List[Document]) -> None:
+        """Заменяет документы для BM25 и перестраивает индекс метаданных"""
+        self.documents = documents
+        self.metadata_index = MetadataIndex(documents)
+        # Индекс BM25 строится лениво и сбрасывается при изменении документов
+        self._bm25 = None
+        self._bm25_doc_len = None
+
+    def _acquire_store_lock(self):
+        """Эксклюзивная блокировка хранилища на все время работы процесса.
+
+        PersistentClient не рассчитан на несколько процессов: они затирают
+        сегменты HNSW друг друга, а чужие векторы не видны без перезапуска.
+        Поэтому бот, пакетная загрузка и снимки работают с хранилищем по очереди.
+        """
+        lock_file = open(self.store_lock_path, 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            raise RuntimeError(
+                f"Хранилище {self.persist_directory} уже используется другим процессом "
+                f"(бот, пакетная загрузка или работа со снимком); остановите его и повторите"
+            )
+        return lock_file
+
+    def _load_documents(self) -> List[Document]:
+        """Читает документы с диска"""
+        documents = []
         if os.path.exists(self.documents_path):
             try:
                 with open(self.documents_path, 'rb') as f:
-                    self.documents = pickle.load(f)
+                    documents = pickle.load(f)
             except Exception as e:
                 print(f"Ошибка при загрузке документов: {e}")
-                self.documents = []
-        else:
-            self.documents = []
+        return documents
 
-        # Инициализируем хранилище, если оно существует
-        if os.path.exists(persist_directory) and os.listdir(persist_directory):
-            self.db = Chroma(
-                persist_directory=persist_directory,
-                embedding_function=self.embeddings
-            )
-        else:
-            self.db = None
+    def _dump_documents(self, documents: List[Document]) -> str:
+        """Записывает документы во временный файл рядом с documents.pkl"""
+        tmp_path = f"{self.documents_path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(documents, f)
+        return tmp_path
+
+    def _save_documents(self, documents: List[Document]) -> None:
+        """Атомарно сохраняет документы на диск (через временный файл)"""
+        os.replace(self._dump_documents(documents), self.documents_path)
+
+    def _reset_ingest_checkpoint(self) -> None:
+        """Удаляет контрольную точку пакетной загрузки, чтобы файлы загрузились заново"""
+        try:
+            os.remove(INGEST_CHECKPOINT)
+        except FileNotFoundError:
+            pass
 
     def add_documents(self, documents: List[Document], collection_name: Optional[str] = None) -> None:
         """Добавляет документы в векторное хранилище"""
-        # Сохраняем документы для BM25
-        self.documents.extend(documents)
+        # Отмечаем время загрузки для фильтрации по нему
+        uploaded_at = time.time()
+        for doc in documents:
+            doc.metadata.setdefault("uploaded_at", uploaded_at)
 
-        # Сохраняем документы на диск
-        try:
-            with open(self.documents_path, 'wb') as f:
-                pickle.dump(self.documents, f)
-        except Exception as e:
-            print(f"Ошибка при сохранении документов: {e}")
-
-        if collection_name:
-            vectorstore = Chroma.from_documents(
-                documents=documents,
-                embedding=self.embeddings,
-                persist_directory=self.persist_directory,
-                collection_name=collection_name
-            )
-        else:
-            vectorstore = Chroma.from_documents(
-                documents=documents,
-                embedding=self.embeddings,
-                persist_directory=self.persist_directory
+        if not documents:
+            return
+
+        # Эмбеддинги считаются до блокировки, чтобы поиск не ждал запросов к API.
+        # При ошибке API в хранилище ничего не попадает, и повтор не создаст дублей
+        vectors = self.embeddings.embed_documents([doc.page_content for doc in documents])
+
+        with self._lock.write():
+            if collection_name and collection_name != self.collection_name:
+                self.collection_name = collection_name
+                self.db = self._open_collection()
+
+            # Сначала векторы, затем documents.pkl и индексы для BM25
+            ids = [str(uuid.uuid4()) for _ in documents]
+            collection = self.client.get_or_create_collection(self.collection_name, embedding_function=None)
+            collection.add(
+                ids=ids,
+                embeddings=vectors,
+                documents=[doc.page_content for doc in documents],
+                metadatas=[doc.metadata for doc in documents]
             )
 
-        self.db = vectorstore
+            # Сохраняем документы для BM25 и на диск
+            try:
+                self._save_documents(self.documents + documents)
+            except Exception:
+                # Без documents.pkl фрагменты потеряются для BM25 после перезапуска
+                collection.delete(ids=ids)
+                raise
+
+            self.documents.extend(documents)
+            self.metadata_index.add(documents)
+            self._bm25 = None
+            self._bm25_doc_len = None
 
     def get_retriever(self, search_kwargs: Optional[Dict[str, Any]] = None):
         """Возвращает ансамблевый ретривер для поиска документов"""
@@ -79,7 +217,7 @@ class VectorStorage:
             search_kwargs = {"k": RETRIEVER_TOP_K}
 
         # Создаем BM25 ретривер
-        bm25_retriever = BM25Retriever.from_documents(self.documents)
+        bm25_retriever = BM25Retriever.from_documents(self.documents, preprocess_func=tokenize)
         bm25_retriever.k = search_kwargs["k"]
 
         # Создаем векторный ретривер
@@ -93,39 +231,202 @@ class VectorStorage:
 
         return ensemble_retriever
 
-    def search(self, query: str, k: int = RETRIEVER_TOP_K) -> List[Document]:
-        """Поиск документов по запросу с использованием ансамблевого ретривера"""
+    def _get_bm25(self) -> BM25Okapi:
+        """Возвращает индекс BM25, построенный тем же токенизатором, что и вопросы"""
+        if self._bm25 is None:
+            self._bm25 = BM25Okapi([tokenize(doc.page_content) for doc in self.documents])
+            # Длины фрагментов для оценки подмножества (get_batch_scores пересобирает их на каждый вызов)
+            self._bm25_doc_len = np.asarray(self._bm25.doc_len, dtype=np.float64)
+        return self._bm25
+
+    def _bm25_subset_scores(self, tokens: List[str], positions: List[int]) -> np.ndarray:
+        """Оценки BM25 только для фрагментов из positions (формула BM25Okapi)"""
+        bm25 = self._get_bm25()
+        doc_len = self._bm25_doc_len[positions]
+        norm = bm25.k1 * (1 - bm25.b + bm25.b * doc_len / bm25.avgdl)
+
+        scores = np.zeros(len(positions))
+        for token in tokens:
+            idf = bm25.idf.get(token)
+            if not idf:
+                continue
+            freqs = np.fromiter((bm25.doc_freqs[i].get(token, 0) for i in positions),
+                                dtype=np.float64, count=len(positions))
+            scores += idf * freqs * (bm25.k1 + 1) / (freqs + norm)
+        return scores
+
+    def _bm25_search(self, tokens: List[str], k: int, positions: Optional[List[int]] = None) -> List[Document]:
+        """Лексический поиск по готовым токенам вопроса (при positions - только среди них)"""
+        if positions is None:
+            positions = range(len(self.documents))
+            scores = self._get_bm25().get_scores(tokens)
+        else:
+            scores = self._bm25_subset_scores(tokens, positions)
+        top = heapq.nlargest(k, range(len(scores)), key=scores.__getitem__)
+        return [self.documents[positions[i]] for i in top]
+
+    def list_sources(self) -> Dict[str, int]:
+        """Возвращает загруженные документы и количество их фрагментов"""
+        return self.metadata_index.count_by("source")
+
+    def search(self,
+               query: Union[str, QueryAnalysis],
+               k: int = RETRIEVER_TOP_K,
+               metadata_filter: Optional[MetadataFilter] = None) -> List[Document]:
+        """Гибридный поиск (BM25 + векторный) с объединением результатов через RRF.
+
+        Принимает текст вопроса или готовый QueryAnalysis; эмбеддинг вопроса
+        вычисляется в фоне, пока считается BM25, и ожидается вне блокировки.
+        Фильтр по метаданным применяется до ранжирования в обеих ветках.
+        """
         if not self.db:
             raise ValueError("Векторное хранилище не инициализировано")
 
-        retriever = self.get_retriever({"k": k})
-        return retriever.invoke(query)
+        if not self.documents:
+            raise ValueError("Нет документов для создания BM25 ретривера")
+
+        analysis = query if isinstance(query, QueryAnalysis) else analyze_query(query, self.embeddings)
+
+        with self._lock.read():
+            positions = None
+            where = None
+            if metadata_filter is not None and not metadata_filter.is_empty():
+                positions = sorted(self.metadata_index.select(metadata_filter))
+                if not positions:
+                    return []
+                where = metadata_filter.to_chroma_where()
+
+            bm25_docs = self._bm25_search(analysis.tokens, k, positions)
+
+        # Эмбеддинг ждем без блокировки: запрос к API не должен задерживать запись
+        embedding = analysis.embedding
+        with self._lock.read():
+            vector_docs = self.db.similarity_search_by_vector(embedding, k=k, filter=where)
+
+        return reciprocal_rank_fusion([bm25_docs, vector_docs], [0.5, 0.5])
+
+    def _reset_collection(self) -> chromadb.Collection:
+        """Пересоздает пустую коллекцию (вызывается под блокировкой на запись)"""
+        try:
+            self.client.delete_collection(self.collection_name)
+        except Exception:
+            # Коллекции еще нет - удалять нечего
+            pass
+        return self.client.create_collection(self.collection_name, embedding_function=None)
 
     def clear(self) -> None:
-        """Очищает векторное хранилище"""
-        self.documents = []  # Очищаем документы для BM25
+        """Очищает векторное хранилище.
 
-        # Удаляем файл с документами
-        if os.path.exists(self.documents_path):
-            try:
-                os.remove(self.documents_path)
-            except Exception as e:
-                print(f"Ошибка при удалении файла документов: {e}")
+        Выполняется под блокировкой на запись, поэтому параллельный поиск видит
+        либо прежнее, либо уже пустое хранилище. Сначала сохраняется пустой
+        список документов, затем пересоздается коллекция.
+        """
+        with self._lock.write():
+            self._set_documents([])
+            self._save_documents([])
+            self._reset_collection()
+            self.db = self._open_collection()
+            self._reset_ingest_checkpoint()
 
-        # Используем встроенный метод для очистки коллекции
-        if self.db:
-            try:
-                # Получаем имя коллекции
-                collection_name = self.db._collection.name
-                # Удаляем коллекцию
-                self.db._client.delete_collection(collection_name)
-                # Создаем новую пустую коллекцию
-                self.db = Chroma(
-                    persist_directory=self.persist_directory,
-                    embedding_function=self.embeddings,
-                    collection_name=collection_name
+    def snapshot(self, snapshot_path: str, quantize: bool = False) -> Dict[str, Any]:
+        """Сохраняет снимок хранилища: фрагменты, векторы и манифест.
+
+        При quantize=True векторы сохраняются в int8 с масштабом на каждую строку.
+        """
+        with self._lock.read():
+            ids, texts, metadatas, vectors = [], [], [], []
+            offset = 0
+            while True:
+                batch = self.db.get(
+                    include=["embeddings", "documents", "metadatas"],
+                    limit=SNAPSHOT_BATCH_SIZE,
+                    offset=offset
                 )
-            except Exception as e:
-                print(f"Ошибка при очистке базы данных: {e}")
-                # Сбрасываем экземпляр базы данных
-                self.db = None
\ No newline at end of file
+                if not batch["ids"]:
+                    break
+                ids.extend(batch["ids"])
+                texts.extend(batch["documents"])
+                metadatas.extend(batch["metadatas"])
+                vectors.append(np.asarray(batch["embeddings"], dtype=np.float32))
+                offset += len(batch["ids"])
+
+            return write_snapshot(
+                snapshot_path,
+                documents=self.documents,
+                records={"ids": ids, "texts": texts, "metadatas": metadatas},
+                vectors=np.concatenate(vectors) if vectors else np.zeros((0, 0), dtype=np.float32),
+                manifest={"collection": self.collection_name, "embedding_model": EMBEDDING_MODEL},
+                quantize=quantize
+            )
+
+    def _get_collection(self, name: str) -> Optional[chromadb.Collection]:
+        """Возвращает коллекцию по имени или None, если ее нет"""
+        try:
+            return self.client.get_collection(name, embedding_function=None)
+        except Exception:
+            return None
+
+    def restore(self, snapshot_path: str) -> Dict[str, Any]:
+        """Восстанавливает хранилище из снимка без повторного вычисления эмбеддингов.
+
+        Векторы сначала загружаются во временную коллекцию, пока поиск работает
+        по текущей. Коллекции и documents.pkl меняются местами только после
+        успешной загрузки, поэтому при ошибке прежний индекс остается целым.
+
+        Хранилище не может быть открыто другим процессом (см. _acquire_store_lock),
+        поэтому перед восстановлением из snapshot.py бота нужно остановить.
+        """
+        snapshot = Snapshot(snapshot_path)
+        manifest = snapshot.manifest
+
+        if manifest.get("embedding_model") != EMBEDDING_MODEL:
+            raise ValueError(
+                f"Снимок создан для модели эмбеддингов {manifest.get('embedding_model')}, "
+                f"а используется {EMBEDDING_MODEL}"
+            )
+
+        target_name = manifest["collection"]
+        suffix = uuid.uuid4().hex[:8]
+        staging_name = f"{target_name}-restore-{suffix}"
+        backup_name = f"{target_name}-backup-{suffix}"
+
+        staging = self.client.create_collection(staging_name, embedding_function=None)
+        try:
+            records = snapshot.records
+            for batch, vectors in snapshot.iter_batches(SNAPSHOT_BATCH_SIZE):
+                staging.add(
+                    ids=records["ids"][batch],
+                    embeddings=vectors.tolist(),
+                    documents=records["texts"][batch],
+                    metadatas=records["metadatas"][batch]
+                )
+        except Exception:
+            self.client.delete_collection(staging_name)
+            raise
+
+        with self._lock.write():
+            documents_tmp_path = self._dump_documents(snapshot.documents)
+
+            current = self._get_collection(target_name)
+            if current is not None:
+                current.modify(name=backup_name)
+            try:
+                staging.modify(name=target_name)
+            except Exception:
+                # Возвращаем прежнюю коллекцию на место
+                if current is not None:
+                    current.modify(name=target_name)
+                self.client.delete_collection(staging_name)
+                os.remove(documents_tmp_path)
+                raise
+
+            os.replace(documents_tmp_path, self.documents_path)
+            self._set_documents(snapshot.documents)
+            self.collection_name = target_name
+            self.db = self._open_collection()
+            self._reset_ingest_checkpoint()
+
+            if current is not None:
+                self.client.delete_collection(backup_name)
+
+        return manifest
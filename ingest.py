@@ -0,0 +1,237 @@
+import argparse
+import glob
+import json
+import logging
+import os
+import sys
+import time
+import zipfile
+from collections import deque
+from itertools import islice
+from multiprocessing import Pool
+from typing import Iterator, List, Optional, Set, Tuple
+
+from langchain_core.documents import Document
+
+from config import INGEST_WORKERS, INGEST_BATCH_SIZE, INGEST_CHECKPOINT
+from rag.document_processor import iter_document, split_documents
+from rag.utils import get_file_extension, get_supported_formats, is_supported_file_type
+from database.storage import VectorStorage
+
+# Задача загрузки: путь к файлу и имя файла внутри архива (None для обычных файлов)
+Task = Tuple[str, Optional[str]]
+
+# Настройка логирования
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    stream=sys.stdout
+)
+
+
+def task_key(task: Task) -> str:
+    """Возвращает уникальный ключ задачи для контрольной точки"""
+    path, member = task
+    path = os.path.abspath(path)
+    return f"{path}::{member}" if member else path
+
+
+def iter_archive(archive_path: str) -> Iterator[Task]:
+    """Перебирает поддерживаемые файлы внутри zip-архива"""
+    with zipfile.ZipFile(archive_path) as archive:
+        for member in archive.namelist():
+            if not member.endswith('/') and is_supported_file_type(member):
+                yield archive_path, member
+
+
+def iter_path(path: str) -> Iterator[Task]:
+    """Перебирает поддерживаемые файлы по пути к файлу или директории"""
+    if get_file_extension(path) == '.zip':
+        yield from iter_archive(path)
+    elif is_supported_file_type(path):
+        yield path, None
+
+
+def collect_tasks(inputs: List[str]) -> List[Task]:
+    """Собирает задачи загрузки из директорий, масок и архивов"""
+    tasks = []
+    seen = set()
+
+    for item in inputs:
+        if os.path.isdir(item):
+            paths = []
+            for root, _, files in os.walk(item):
+                paths.extend(os.path.join(root, name) for name in sorted(files))
+        elif glob.has_magic(item):
+            paths = sorted(glob.glob(item, recursive=True))
+        else:
+            paths = [item]
+
+        for path in paths:
+            if not os.path.isfile(path):
+                logging.warning(f"Файл не найден: {path}")
+                continue
+            for task in iter_path(path):
+                key = task_key(task)
+                if key not in seen:
+                    seen.add(key)
+                    tasks.append(task)
+
+    return tasks
+
+
+def split_archive_member(archive_path: str, member: str) -> List[Document]:
+    """Разбор и разбиение документа из zip-архива без распаковки на диск"""
+    with zipfile.ZipFile(archive_path) as archive:
+        with archive.open(member) as stream:
+            chunks = split_documents(iter_document(stream, member))
+
+    for chunk in chunks:
+        chunk.metadata["file_path"] = f"{archive_path}::{member}"
+
+    return chunks
+
+
+def process_task(task: Task) -> Tuple[str, List[Document], Optional[str]]:
+    """Разбор и разбиение одного файла (выполняется в дочернем процессе)"""
+    path, member = task
+    try:
+        if member:
+            chunks = split_archive_member(path, member)
+        else:
+            chunks = split_documents(iter_document(path))
+    except Exception as e:
+        return task_key(task), [], str(e)
+
+    # Загрузчики сами перехватывают ошибки разбора, поэтому пустой результат - тоже ошибка
+    if not chunks:
+        return task_key(task), [], "не удалось извлечь текст (файл поврежден, защищен или пуст)"
+    return task_key(task), chunks, None
+
+
+class Checkpoint:
+    """Контрольная точка загрузки для возобновления после сбоя"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.done: Set[str] = set()
+
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self.done = set(json.load(f))
+            except Exception as e:
+                logging.error(f"Ошибка при чтении контрольной точки: {e}")
+
+    def update(self, keys: List[str]) -> None:
+        """Отмечает файлы как загруженные и сохраняет контрольную точку на диск"""
+        self.done.update(keys)
+        if not self.path:
+            return
+
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(sorted(self.done), f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+
+def ingest(inputs: List[str],
+           workers: int = INGEST_WORKERS,
+           batch_size: int = INGEST_BATCH_SIZE,
+           checkpoint_path: str = INGEST_CHECKPOINT,
+           collection_name: Optional[str] = None) -> None:
+    """Пакетная загрузка документов в векторное хранилище.
+
+    Запускается при остановленном боте: хранилище занимает один процесс,
+    и пока его держит бот, загрузка завершится с ошибкой (и наоборот).
+    """
+    started = time.monotonic()
+    checkpoint = Checkpoint(checkpoint_path)
+
+    tasks = collect_tasks(inputs)
+    pending = [task for task in tasks if task_key(task) not in checkpoint.done]
+    skipped = len(tasks) - len(pending)
+    logging.info(f"Найдено файлов: {len(tasks)}, уже загружено: {skipped}, к загрузке: {len(pending)}")
+
+    if not pending:
+        return
+
+    batch: List[Document] = []
+    batch_keys: List[str] = []
+    loaded = failed = total_chunks = 0
+    storage: Optional[VectorStorage] = None
+
+    def flush() -> None:
+        nonlocal total_chunks
+        if batch:
+            storage.add_documents(batch, collection_name)
+            total_chunks += len(batch)
+        checkpoint.update(batch_keys)
+        logging.info(f"Загружено файлов: {loaded}/{len(pending)}, фрагментов: {total_chunks}")
+        batch.clear()
+        batch_keys.clear()
+
+    # Файлы разбираются параллельно, эмбеддинги и запись идут пакетами в основном процессе.
+    # Пул создается до открытия хранилища, чтобы дочерние процессы не унаследовали
+    # соединения SQLite и потоки клиента Chroma.
+    with Pool(processes=workers) as pool:
+        storage = VectorStorage()
+
+        # Одновременно в работе не больше двух файлов на процесс: иначе разобранные
+        # фрагменты копятся в памяти, пока основной процесс ждет эмбеддинги
+        tasks_iter = iter(pending)
+        in_progress = deque(
+            pool.apply_async(process_task, (task,)) for task in islice(tasks_iter, workers * 2)
+        )
+
+        while in_progress:
+            key, chunks, error = in_progress.popleft().get()
+            next_task = next(tasks_iter, None)
+            if next_task is not None:
+                in_progress.append(pool.apply_async(process_task, (next_task,)))
+
+            if error:
+                failed += 1
+                logging.error(f"Ошибка при обработке {key}: {error}")
+                continue
+
+            loaded += 1
+            batch.extend(chunks)
+            batch_keys.append(key)
+
+            if len(batch) >= batch_size:
+                flush()
+
+    if batch or batch_keys:
+        flush()
+
+    elapsed = time.monotonic() - started
+    logging.info(
+        f"Загрузка завершена за {elapsed:.1f} с: "
+        f"файлов {loaded}, ошибок {failed}, пропущено {skipped}, фрагментов {total_chunks} "
+        f"({loaded / elapsed:.2f} файлов/с, {total_chunks / elapsed:.1f} фрагментов/с)"
+    )
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description=f"Пакетная загрузка документов ({get_supported_formats()}, zip-архивы) в векторное хранилище"
+    )
+    parser.add_argument("inputs", nargs="+", help="Файлы, директории, маски или zip-архивы")
+    parser.add_argument("--workers", type=int, default=INGEST_WORKERS,
+                        help="Количество процессов для разбора документов")
+    parser.add_argument("--batch-size", type=int, default=INGEST_BATCH_SIZE,
+                        help="Количество фрагментов в одном пакете записи")
+    parser.add_argument("--checkpoint", default=INGEST_CHECKPOINT,
+                        help="Файл контрольной точки для возобновления загрузки "
+                             "(файл по умолчанию сбрасывается при очистке и восстановлении хранилища)")
+    parser.add_argument("--collection", default=None, help="Имя коллекции в Chroma")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    try:
+        ingest(args.inputs, args.workers, args.batch_size, args.checkpoint, args.collection)
+    except KeyboardInterrupt:
+        logging.info("Загрузка прервана, прогресс сохранен в контрольной точке")
\ No newline at end of file
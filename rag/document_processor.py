@@ -1,117 +1,268 @@
+import io
 import os
+import codecs
+import posixpath
+import zipfile
 import fitz
-import ebooklib
-from ebooklib import epub
 from bs4 import BeautifulSoup
-from typing import List, Optional
+from lxml import etree
+from urllib.parse import unquote
+from typing import BinaryIO, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 from langchain_core.documents import Document
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from config import CHUNK_SIZE, CHUNK_OVERLAP
 
+# Источник документа: путь к файлу, содержимое в памяти или бинарный поток
+DocumentSource = Union[str, bytes, bytearray, memoryview, BinaryIO]
 
-def load_pdf(file_path: str) -> List[Document]:
-    """Загрузка PDF файла и извлечение текста"""
-    documents = []
+# Размер блока при потоковом чтении
+READ_CHUNK_SIZE = 64 * 1024
+
+
+# Реестр загрузчиков: расширение файла -> генератор документов
+LOADERS: Dict[str, Callable[..., Iterator[Document]]] = {}
+
+
+def register_loader(*extensions: str):
+    """Регистрирует загрузчик для указанных расширений файлов"""
+    def decorator(loader: Callable[..., Iterator[Document]]):
+        for extension in extensions:
+            LOADERS[extension] = loader
+        return loader
+    return decorator
+
+
+def _describe_source(source: DocumentSource, file_name: Optional[str]) -> Tuple[str, str]:
+    """Возвращает имя файла и путь для метаданных документа"""
+    file_path = source if isinstance(source, str) else (file_name or "")
+    return os.path.basename(file_name or file_path), file_path
+
+
+def _read_bytes(source: DocumentSource) -> bytes:
+    """Возвращает содержимое источника целиком"""
+    if isinstance(source, str):
+        with open(source, 'rb') as f:
+            return f.read()
+    if isinstance(source, io.BytesIO):
+        # getvalue() не копирует буфер, если на него нет других ссылок
+        return source.getvalue()
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return bytes(source)
+    return source.read()
+
+
+def _iter_chunks(source: DocumentSource) -> Iterator[bytes]:
+    """Читает источник блоками по READ_CHUNK_SIZE"""
+    if isinstance(source, str):
+        with open(source, 'rb') as f:
+            yield from iter(lambda: f.read(READ_CHUNK_SIZE), b'')
+    elif isinstance(source, (bytes, bytearray, memoryview)):
+        view = memoryview(source).cast('B')
+        for start in range(0, len(view), READ_CHUNK_SIZE):
+            yield bytes(view[start:start + READ_CHUNK_SIZE])
+    else:
+        yield from iter(lambda: source.read(READ_CHUNK_SIZE), b'')
+
+
+def _open_zip(source: DocumentSource) -> zipfile.ZipFile:
+    """Открывает источник как zip-архив"""
+    if isinstance(source, (str, io.BytesIO)):
+        return zipfile.ZipFile(source)
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return zipfile.ZipFile(io.BytesIO(source))
+    # Потоки без быстрого произвольного доступа сначала читаем в память
+    return zipfile.ZipFile(io.BytesIO(source.read()))
+
+
+@register_loader('.pdf')
+def iter_pdf(source: DocumentSource, file_name: Optional[str] = None) -> Iterator[Document]:
+    """Загрузка PDF файла и извлечение текста по страницам"""
+    source_name, file_path = _describe_source(source, file_name)
 
     try:
-        pdf = fitz.open(file_path)
-        for i, page in enumerate(pdf):
-            text = page.get_text()
-            if text.strip():
-                doc = Document(
-                    page_content=text,
-                    metadata={
-                        "source": os.path.basename(file_path),
-                        "page": i + 1,
-                        "file_path": file_path,
-                        "file_type": "pdf"
-                    }
-                )
-                documents.append(doc)
-        pdf.close()
+        if isinstance(source, str):
+            pdf = fitz.open(source)
+        else:
+            pdf = fitz.open(stream=_read_bytes(source), filetype="pdf")
+        try:
+            for i, page in enumerate(pdf):
+                text = page.get_text()
+                if text.strip():
+                    yield Document(
+                        page_content=text,
+                        metadata={
+                            "source": source_name,
+                            "page": i + 1,
+                            "file_path": file_path,
+                            "file_type": "pdf"
+                        }
+                    )
+        finally:
+            pdf.close()
     except Exception as e:
         print(f"Ошибка при загрузке PDF: {e}")
 
-    return documents
 
+@register_loader('.fb2')
+def iter_fb2(source: DocumentSource, file_name: Optional[str] = None) -> Iterator[Document]:
+    """Загрузка FB2 файла и извлечение текста по разделам (инкрементальный разбор XML)"""
+    source_name, file_path = _describe_source(source, file_name)
+    section = 0
 
-def load_fb2(file_path: str) -> List[Document]:
-    """Загрузка FB2 файла и извлечение текста"""
-    documents = []
+    def read_sections(parser: etree.XMLPullParser) -> Iterator[str]:
+        for _, element in parser.read_events():
+            if not isinstance(element.tag, str):
+                continue
 
-    try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
+            tag = etree.QName(element).localname
+            if tag == 'section':
+                # Вложенные разделы уже очищены, поэтому берется только собственный текст
+                yield "".join(element.itertext())
+                element.clear(keep_tail=True)
+            elif tag == 'binary':
+                # Встроенные изображения не нужны, освобождаем память сразу
+                element.clear(keep_tail=True)
 
-        # Простой парсинг FB2 (может потребоваться более сложная логика)
-        soup = BeautifulSoup(content, 'lxml')
+    def iter_sections() -> Iterator[str]:
+        # Внешние сущности и сеть отключены, лимиты размера дерева lxml не снимаются:
+        # файлы приходят от пользователей бота
+        parser = etree.XMLPullParser(events=("end",), recover=True,
+                                     resolve_entities=False, no_network=True)
+        for chunk in _iter_chunks(source):
+            parser.feed(chunk)
+            yield from read_sections(parser)
+        parser.close()
+        yield from read_sections(parser)
 
-        # Извлекаем текст из разделов body
-        for i, section in enumerate(soup.find_all('section')):
-            text = section.get_text()
+    try:
+        for text in iter_sections():
             if text.strip():
-                doc = Document(
+                section += 1
+                yield Document(
                     page_content=text,
                     metadata={
-                        "source": os.path.basename(file_path),
-                        "section": i + 1,
+                        "source": source_name,
+                        "section": section,
                         "file_path": file_path,
                         "file_type": "fb2"
                     }
                 )
-                documents.append(doc)
     except Exception as e:
         print(f"Ошибка при загрузке FB2: {e}")
 
-    return documents
-
 
-def load_text(file_path: str) -> List[Document]:
-    """Загрузка текстового файла"""
-    documents = []
+@register_loader('.txt')
+def iter_text(source: DocumentSource, file_name: Optional[str] = None) -> Iterator[Document]:
+    """Загрузка текстового файла (потоковое декодирование)"""
+    source_name, file_path = _describe_source(source, file_name)
 
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            text = f.read()
-
-        if text.strip():
-            doc = Document(
-                page_content=text,
-                metadata={
-                    "source": os.path.basename(file_path),
-                    "file_path": file_path,
-                    "file_type": "text"
-                }
-            )
-            documents.append(doc)
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        parts = [decoder.decode(chunk) for chunk in _iter_chunks(source)]
+        parts.append(decoder.decode(b'', final=True))
+        text = "".join(parts)
     except Exception as e:
         print(f"Ошибка при загрузке текстового файла: {e}")
+        return
 
-    return documents
+    if text.strip():
+        yield Document(
+            page_content=text,
+            metadata={
+                "source": source_name,
+                "file_path": file_path,
+                "file_type": "text"
+            }
+        )
 
 
-def load_document(file_path: str) -> List[Document]:
-    """Загрузка документа в зависимости от его формата"""
-    file_extension = os.path.splitext(file_path)[1].lower()
-
-    if file_extension == '.pdf':
-        return load_pdf(file_path)
-    elif file_extension == '.fb2':
-        return load_fb2(file_path)
-    elif file_extension == '.txt':
-        return load_text(file_path)
-    else:
+@register_loader('.epub')
+def iter_epub(source: DocumentSource, file_name: Optional[str] = None) -> Iterator[Document]:
+    """Загрузка EPUB файла по главам в порядке spine.
+
+    Главы распаковываются и разбираются по одной, поэтому в памяти
+    не держится вся книга целиком.
+    """
+    source_name, file_path = _describe_source(source, file_name)
+    chapter = 0
+
+    try:
+        with _open_zip(source) as book:
+            # Служебные файлы книги разбираются без внешних сущностей и сети
+            parser = etree.XMLParser(resolve_entities=False, no_network=True)
+            container = etree.fromstring(book.read("META-INF/container.xml"), parser)
+            opf_path = container.find(".//{*}rootfile").get("full-path")
+            opf = etree.fromstring(book.read(opf_path), parser)
+            base_dir = posixpath.dirname(opf_path)
+
+            manifest = {
+                item.get("id"): item.get("href")
+                for item in opf.iterfind(".//{*}manifest/{*}item")
+            }
+
+            for itemref in opf.iterfind(".//{*}spine/{*}itemref"):
+                href = manifest.get(itemref.get("idref"))
+                if not href:
+                    continue
+
+                item_path = posixpath.normpath(posixpath.join(base_dir, unquote(href.split('#')[0])))
+                try:
+                    text = BeautifulSoup(book.read(item_path), 'lxml').get_text()
+                except Exception as e:
+                    # Битая ссылка в spine не должна прерывать загрузку остальных глав
+                    print(f"Ошибка при загрузке главы EPUB {item_path}: {e}")
+                    continue
+                if text.strip():
+                    chapter += 1
+                    yield Document(
+                        page_content=text,
+                        metadata={
+                            "source": source_name,
+                            "chapter": chapter,
+                            "file_path": file_path,
+                            "file_type": "epub"
+                        }
+                    )
+    except Exception as e:
+        print(f"Ошибка при загрузке EPUB: {e}")
+
+
+def get_supported_extensions() -> List[str]:
+    """Возвращает список поддерживаемых расширений файлов"""
+    return list(LOADERS)
+
+
+def iter_document(source: DocumentSource, file_name: Optional[str] = None) -> Iterator[Document]:
+    """Потоковая загрузка документа загрузчиком, зарегистрированным для его формата.
+
+    Источником может быть путь к файлу, bytes/memoryview или бинарный поток;
+    для источников в памяти формат определяется по file_name.
+    """
+    name = file_name or (source if isinstance(source, str) else "")
+    file_extension = os.path.splitext(name)[1].lower()
+
+    loader = LOADERS.get(file_extension)
+    if loader is None:
         raise ValueError(f"Неподдерживаемый формат файла: {file_extension}")
 
+    return loader(source, file_name)
+
+
+def load_document(source: DocumentSource, file_name: Optional[str] = None) -> List[Document]:
+    """Загрузка документа в зависимости от его формата"""
+    return list(iter_document(source, file_name))
+
 
-def split_documents(documents: List[Document],
+def split_documents(documents: Iterable[Document],
                     chunk_size: int = CHUNK_SIZE,
                     chunk_overlap: int = CHUNK_OVERLAP) -> List[Document]:
-    """Разделение документов на более мелкие фрагменты"""
+    """Разделение документов на более мелкие фрагменты (документы обрабатываются по одному)"""
     text_splitter = RecursiveCharacterTextSplitter(
         chunk_size=chunk_size,
         chunk_overlap=chunk_overlap,
         length_function=len,
     )
-    chunks = text_splitter.split_documents(documents)
+    chunks = []
+    for document in documents:
+        chunks.extend(text_splitter.split_documents([document]))
     return chunks
\ No newline at end of file
@@ -1,18 +1,28 @@
 import requests
 from typing import List
 from langchain.embeddings.base import Embeddings
-from config import HUGGINGFACE_API_KEY, EMBEDDING_MODEL
+from config import HUGGINGFACE_API_KEY, EMBEDDING_MODEL, EMBEDDING_BATCH_SIZE
 
 class HuggingFaceEmbeddings(Embeddings):
     """Класс для создания эмбеддингов с использованием Hugging Face API"""
 
-    def __init__(self, model_name: str = EMBEDDING_MODEL):
+    def __init__(self, model_name: str = EMBEDDING_MODEL, batch_size: int = EMBEDDING_BATCH_SIZE):
         self.model_name = model_name
+        self.batch_size = batch_size
         self.api_key = HUGGINGFACE_API_KEY
         self.api_url = f"https://router.huggingface.co/hf-inference/models/{model_name}/pipeline/feature-extraction"
+        # Переиспользуем соединение между запросами
+        self.session = requests.Session()
 
     def embed_documents(self, texts: List[str]) -> List[List[float]]:
-        """Создание эмбеддингов для списка текстов"""
+        """Создание эмбеддингов для списка текстов (пакетами по batch_size)"""
+        embeddings = []
+        for start in range(0, len(texts), self.batch_size):
+            embeddings.extend(self._embed_batch(texts[start:start + self.batch_size]))
+        return embeddings
+
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        """Запрос эмбеддингов для одного пакета текстов"""
         headers = {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json"
@@ -20,7 +30,7 @@ class HuggingFaceEmbeddings(Embeddings):
 
         data = {"inputs": texts}
 
-        response = requests.post(
+        response = self.session.post(
             self.api_url,
             headers=headers,
             json=data
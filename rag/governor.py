@@ -0,0 +1,218 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Deque, Dict, Hashable, Optional, Tuple
+
+from rag.llm import OpenRouterLLM
+from config import (
+    MODEL_NAME, FALLBACK_MODEL_NAME, LLM_RATE_LIMIT, LLM_RATE_BURST,
+    LLM_MAX_IN_FLIGHT, LLM_QUEUE_DEADLINE, LLM_FALLBACK_LATENCY
+)
+
+
+class TokenBucket:
+    """Ограничение частоты запросов по алгоритму token bucket"""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self) -> None:
+        """Ожидает, пока в ведре появится токен, и забирает его"""
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class ModelLane:
+    """Очередь запросов к одной модели.
+
+    Ограничивает частоту и число одновременных запросов, а свободные слоты
+    раздает пользователям по кругу, чтобы один пользователь не занимал всю очередь.
+    """
+
+    def __init__(self, model: str, rate: float, burst: int, max_in_flight: int):
+        self.model = model
+        self.bucket = TokenBucket(rate, burst)
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        # Очереди ожидающих запросов по пользователям и порядок их обхода
+        self._queues: Dict[Hashable, Deque[Tuple[float, asyncio.Future]]] = {}
+        self._turns: Deque[Hashable] = deque()
+
+    def queue_latency(self) -> float:
+        """Сколько секунд ждет самый старый запрос в очереди"""
+        oldest = min((queue[0][0] for queue in self._queues.values()), default=None)
+        return 0.0 if oldest is None else time.monotonic() - oldest
+
+    async def acquire(self, user_id: Hashable, deadline: float) -> None:
+        """Занимает слот для запроса; ждет не дольше deadline (по time.monotonic)"""
+        if self.in_flight < self.max_in_flight and not self._turns:
+            self.in_flight += 1
+            return
+
+        ticket = asyncio.get_running_loop().create_future()
+        entry = (time.monotonic(), ticket)
+        if user_id not in self._queues:
+            self._queues[user_id] = deque()
+            self._turns.append(user_id)
+        self._queues[user_id].append(entry)
+
+        try:
+            await asyncio.wait_for(ticket, timeout=max(0.0, deadline - time.monotonic()))
+        except BaseException:
+            if ticket.done() and not ticket.cancelled():
+                # Слот уже выдан, но ожидающий отменен - возвращаем слот
+                self.release()
+            else:
+                self._discard(user_id, entry)
+            raise
+
+    def release(self) -> None:
+        """Освобождает слот и передает его следующему пользователю"""
+        self.in_flight -= 1
+        self._dispatch()
+
+    def _discard(self, user_id: Hashable, entry: Tuple[float, asyncio.Future]) -> None:
+        queue = self._queues.get(user_id)
+        if queue is None or entry not in queue:
+            return
+        queue.remove(entry)
+        if not queue:
+            del self._queues[user_id]
+            self._turns.remove(user_id)
+
+    def _dispatch(self) -> None:
+        while self.in_flight < self.max_in_flight and self._turns:
+            user_id = self._turns.popleft()
+            queue = self._queues[user_id]
+            _, ticket = queue.popleft()
+            if queue:
+                self._turns.append(user_id)
+            else:
+                del self._queues[user_id]
+
+            if ticket.done():
+                continue
+            self.in_flight += 1
+            ticket.set_result(None)
+
+
+class LLMGovernor:
+    """Регулятор запросов к OpenRouter.
+
+    Одинаковые одновременные промпты объединяются в один запрос, запросы
+    проходят через ограничение частоты и числа одновременных вызовов,
+    а запросы, прождавшие в очереди к основной модели дольше порога,
+    переходят к резервной.
+    """
+
+    def __init__(self,
+                 model: str = MODEL_NAME,
+                 fallback_model: Optional[str] = FALLBACK_MODEL_NAME,
+                 rate: float = LLM_RATE_LIMIT,
+                 burst: int = LLM_RATE_BURST,
+                 max_in_flight: int = LLM_MAX_IN_FLIGHT,
+                 deadline: float = LLM_QUEUE_DEADLINE,
+                 fallback_latency: float = LLM_FALLBACK_LATENCY):
+        self.primary = ModelLane(model, rate, burst, max_in_flight)
+        self.fallback = ModelLane(fallback_model, rate, burst, max_in_flight) if fallback_model else None
+        self.deadline = deadline
+        self.fallback_latency = fallback_latency
+        # Запросы, которые сейчас выполняются, по тексту промпта
+        self._pending: Dict[str, asyncio.Task] = {}
+
+    async def generate(self, prompt: str, user_id: Hashable = None) -> str:
+        """Генерирует ответ; при таком же промпте в работе ждет его результат.
+
+        Запрос выполняется отдельной задачей, поэтому отмена одного из ожидающих
+        не отменяет ответ для остальных.
+        """
+        task = self._pending.get(prompt)
+        if task is None:
+            task = asyncio.ensure_future(self._generate(prompt, user_id))
+            self._pending[prompt] = task
+            task.add_done_callback(lambda done: self._finish(prompt, done))
+        return await asyncio.shield(task)
+
+    def _finish(self, prompt: str, task: asyncio.Future) -> None:
+        if self._pending.get(prompt) is task:
+            del self._pending[prompt]
+        if not task.cancelled():
+            # Помечаем исключение как полученное, если ожидающих не осталось
+            task.exception()
+
+    async def _acquire_lane(self, user_id: Hashable, deadline: float) -> ModelLane:
+        """Занимает слот в основной очереди, а при долгом ожидании - в первой освободившейся.
+
+        Запрос, прождавший дольше fallback_latency, не теряет место в основной
+        очереди, а дополнительно встает в очередь к резервной модели.
+        """
+        if self.fallback is None:
+            await self.primary.acquire(user_id, deadline)
+            return self.primary
+
+        attempts: Dict[asyncio.Task, ModelLane] = {}
+        winner = None
+        try:
+            if self.primary.queue_latency() <= self.fallback_latency:
+                attempts[asyncio.ensure_future(self.primary.acquire(user_id, deadline))] = self.primary
+                timeout = min(self.fallback_latency, max(0.0, deadline - time.monotonic()))
+                await asyncio.wait(attempts, timeout=timeout)
+
+            if not any(task.done() for task in attempts):
+                logging.warning(
+                    f"Очередь к {self.primary.model} превышает {self.fallback_latency} с, "
+                    f"запрос ставится и в очередь к резервной модели {self.fallback.model}"
+                )
+                attempts[asyncio.ensure_future(self.fallback.acquire(user_id, deadline))] = self.fallback
+
+            while winner is None:
+                pending = [task for task in attempts if not task.done()]
+                if pending:
+                    await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+                for task in attempts:
+                    if task.done() and not task.cancelled() and task.exception() is None:
+                        winner = task
+                        break
+                else:
+                    if all(task.done() for task in attempts):
+                        # Во всех очередях истек срок ожидания
+                        raise asyncio.TimeoutError()
+
+            return attempts[winner]
+        finally:
+            # Снимаем остальные попытки и возвращаем слоты, которые они успели занять
+            for task in attempts:
+                if task is not winner and not task.done():
+                    task.cancel()
+            await asyncio.gather(*attempts, return_exceptions=True)
+            for task, lane in attempts.items():
+                if task is not winner and not task.cancelled() and task.exception() is None:
+                    lane.release()
+
+    async def _generate(self, prompt: str, user_id: Hashable) -> str:
+        deadline = time.monotonic() + self.deadline
+        lane = await self._acquire_lane(user_id, deadline)
+        try:
+            await asyncio.wait_for(lane.bucket.acquire(), timeout=max(0.0, deadline - time.monotonic()))
+            llm = OpenRouterLLM(model=lane.model, temperature=0)
+            return await asyncio.to_thread(llm.invoke, prompt)
+        finally:
+            lane.release()
+
+
+# Общий регулятор для всех пользователей бота
+governor = LLMGovernor()
@@ -0,0 +1,61 @@
+import re
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from typing import List
+
+import snowballstemmer
+from langchain.embeddings.base import Embeddings
+
+# Слова из букв и цифр (включая кириллицу)
+TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+CYRILLIC_PATTERN = re.compile(r"[а-я]")
+
+_russian_stemmer = snowballstemmer.stemmer("russian")
+_english_stemmer = snowballstemmer.stemmer("english")
+
+# Пул для вычисления эмбеддинга вопроса параллельно с лексическим поиском
+_embedding_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="query-embedding")
+
+
+def normalize_text(text: str) -> str:
+    """Приводит текст к нижнему регистру и заменяет ё на е"""
+    return text.lower().replace("ё", "е")
+
+
+@lru_cache(maxsize=100_000)
+def stem_word(word: str) -> str:
+    """Возвращает основу слова стеммером Snowball для его языка"""
+    if CYRILLIC_PATTERN.search(word):
+        return _russian_stemmer.stemWord(word)
+    return _english_stemmer.stemWord(word)
+
+
+def tokenize(text: str) -> List[str]:
+    """Разбивает текст на основы слов. Используется и для индекса BM25, и для вопросов"""
+    return [stem_word(word) for word in TOKEN_PATTERN.findall(normalize_text(text))]
+
+
+class QueryAnalysis:
+    """Результат однократного анализа вопроса, общий для всех этапов поиска"""
+
+    def __init__(self, text: str, normalized: str, tokens: List[str], embedding: Future):
+        self.text = text
+        self.normalized = normalized
+        self.tokens = tokens
+        self._embedding = embedding
+
+    @property
+    def embedding(self) -> List[float]:
+        """Эмбеддинг вопроса (ожидает завершения фонового вычисления)"""
+        return self._embedding.result()
+
+
+def analyze_query(query: str, embeddings: Embeddings) -> QueryAnalysis:
+    """Анализирует вопрос: нормализация и токены сразу, эмбеддинг в фоне"""
+    embedding = _embedding_executor.submit(embeddings.embed_query, query)
+    return QueryAnalysis(
+        text=query,
+        normalized=normalize_text(query),
+        tokens=tokenize(query),
+        embedding=embedding
+    )
@@ -6,6 +6,7 @@ from langchain.prompts import PromptTemplate
 
 from rag.embeddings import HuggingFaceEmbeddings
 from rag.llm import OpenRouterLLM
+from rag.governor import governor
 from config import CHROMA_DB_DIR, MODEL_NAME
 
 
@@ -42,8 +43,8 @@ def search_documents(query: str, retriever) -> List[Document]:
     return retriever.invoke(query)
 
 
-def generate_response(query: str, documents: List[Document], model_name: str = MODEL_NAME) -> str:
-    """Генерация ответа на основе найденных документов с использованием OpenRouter"""
+def build_prompt(query: str, documents: List[Document]) -> str:
+    """Создание промпта с контекстом из найденных документов и вопросом"""
     # Создание контекста из найденных документов
     context = "\n\n".join([doc.page_content for doc in documents])
 
@@ -71,7 +72,12 @@ def generate_response(query: str, documents: List[Document], model_name: str = M
     )
 
     # Создание промпта с контекстом и вопросом
-    formatted_prompt = prompt.format(context=context, query=query)
+    return prompt.format(context=context, query=query)
+
+
+def generate_response(query: str, documents: List[Document], model_name: str = MODEL_NAME) -> str:
+    """Генерация ответа на основе найденных документов с использованием OpenRouter"""
+    formatted_prompt = build_prompt(query, documents)
 
     # Генерация ответа с помощью OpenRouter LLM
     llm = OpenRouterLLM(model=model_name, temperature=0)
@@ -80,6 +86,11 @@ def generate_response(query: str, documents: List[Document], model_name: str = M
     return response
 
 
+async def agenerate_response(query: str, documents: List[Document], user_id=None) -> str:
+    """Генерация ответа через общий регулятор запросов к OpenRouter"""
+    return await governor.generate(build_prompt(query, documents), user_id)
+
+
 def extract_sources(documents: List[Document]) -> List[str]:
     """Извлечение источников из документов"""
     sources = []
@@ -93,6 +104,8 @@ def extract_sources(documents: List[Document]) -> List[str]:
             source_info.append(f"страница {doc.metadata['page']}")
         elif 'section' in doc.metadata:
             source_info.append(f"раздел {doc.metadata['section']}")
+        elif 'chapter' in doc.metadata:
+            source_info.append(f"глава {doc.metadata['chapter']}")
 
         source = ", ".join(source_info)
         if source and source not in sources:
@@ -1,17 +1,6 @@
 import os
-import tempfile
 from typing import Optional
-
-
-def save_telegram_file(file_obj, file_name: str) -> str:
-    """Сохраняет файл, полученный от Telegram, во временную директорию"""
-    temp_dir = tempfile.gettempdir()
-    file_path = os.path.join(temp_dir, file_name)
-
-    with open(file_path, 'wb') as f:
-        f.write(file_obj.getvalue())
-
-    return file_path
+from rag.document_processor import LOADERS
 
 
 def get_file_extension(file_name: str) -> Optional[str]:
@@ -22,6 +11,10 @@ def get_file_extension(file_name: str) -> Optional[str]:
 
 def is_supported_file_type(file_name: str) -> bool:
     """Проверяет, поддерживается ли тип файла"""
-    supported_extensions = ['.pdf', '.fb2', '.txt']
     ext = get_file_extension(file_name)
-    return ext in supported_extensions
\ No newline at end of file
+    return ext in LOADERS
+
+
+def get_supported_formats() -> str:
+    """Возвращает список поддерживаемых форматов для сообщений пользователю"""
+    return ", ".join(ext.lstrip('.').upper() for ext in LOADERS)
\ No newline at end of file
@@ -0,0 +1,60 @@
+import argparse
+import logging
+import sys
+import time
+from typing import List, Optional
+
+from database.storage import VectorStorage
+
+# Настройка логирования
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    stream=sys.stdout
+)
+
+
+def create_snapshot(snapshot_path: str, quantize: bool = False) -> None:
+    """Сохраняет снимок векторного хранилища в архив"""
+    started = time.monotonic()
+    manifest = VectorStorage().snapshot(snapshot_path, quantize=quantize)
+    logging.info(
+        f"Снимок сохранен в {snapshot_path} за {time.monotonic() - started:.1f} с: "
+        f"векторов {manifest['count']} ({manifest['dtype']}), фрагментов {manifest['documents']}"
+    )
+
+
+def restore_snapshot(snapshot_path: str) -> None:
+    """Восстанавливает векторное хранилище из архива без повторного вычисления эмбеддингов"""
+    started = time.monotonic()
+    manifest = VectorStorage().restore(snapshot_path)
+    logging.info(
+        f"Хранилище восстановлено из {snapshot_path} за {time.monotonic() - started:.1f} с: "
+        f"векторов {manifest['count']}, фрагментов {manifest['documents']}"
+    )
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Снимки векторного хранилища (запускать при остановленном боте и без пакетной загрузки)"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    create_parser = subparsers.add_parser("create", help="Сохранить снимок хранилища")
+    create_parser.add_argument("path", help="Путь к архиву снимка")
+    create_parser.add_argument("--quantize", action="store_true",
+                               help="Сохранить векторы в int8 вместо float32")
+
+    restore_parser = subparsers.add_parser("restore",
+                                           help="Восстановить хранилище из снимка (остановите бота перед восстановлением)")
+    restore_parser.add_argument("path", help="Путь к архиву снимка")
+
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.command == "create":
+        create_snapshot(args.path, args.quantize)
+    else:
+        restore_snapshot(args.path)